@@ -7,6 +7,12 @@ from threading import Thread
 import socket
 import evolver_server
 import os
+import sys
+from traceback import print_exc
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 conf = {}
 CONF_FILENAME = 'conf.yml'
@@ -22,7 +28,7 @@ if __name__ == '__main__':
     evolver_ip = s.getsockname()[0]
     s.close()
     with open(os.path.realpath(os.path.join(os.getcwd(),os.path.dirname(__file__), CONF_FILENAME)), 'r') as ymlfile:
-        conf = yaml.load(ymlfile)
+        conf = yaml.load(ymlfile, Loader=SafeLoader)
 
     conf['evolver_ip'] = evolver_ip
 
@@ -30,7 +36,7 @@ if __name__ == '__main__':
     server_loop = asyncio.new_event_loop()
     ms = MultiServer(loop=server_loop)
     app1 = ms.add_app(port = conf['port'])
-    evolver_server.attach(app1, conf)
+    evolver_server.attach(app1, conf, server_loop)
     ms.run_all()
 
     # Set up data broadcasting
@@ -47,6 +53,10 @@ if __name__ == '__main__':
             try:
                 running = True
                 bloop.run_until_complete(evolver_server.broadcast(commands_in_queue))
+            except Exception:
+                print_exc(file = sys.stdout)
+            finally:
                 running = False
-            except:
-                pass
+        else:
+            # Sleep until the next broadcast is due or a command comes in
+            evolver_server.wait_for_commands(conf['broadcast_timing'] - (current_time - last_time))
@@ -1,22 +1,34 @@
 import socketio
 import serial
-import evolver
 import time
 import asyncio
 import json
 import sys
 import os
 import yaml
+import copy
+import threading
+from functools import lru_cache
 from traceback import print_exc
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
 
 LOCATION = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 IMMEDIATE = 'immediate_command_char'
 RECURRING = 'recurring_command_char'
 CALIBRATIONS_FILENAME = "calibrations.json"
+CONF_FILENAME = "conf.yml"
+CALIBRATIONS_PATH = os.path.join(LOCATION, CALIBRATIONS_FILENAME)
+CONF_PATH = os.path.join(LOCATION, CONF_FILENAME)
 
 evolver_conf = {}
 serial_connection = None
+server_loop = None
 command_queue = []
+command_event = threading.Event()
+calibrations_cache = {'stat': None, 'data': None}
 sio = socketio.AsyncServer(async_handlers=True)
 
 class EvolverSerialError(Exception):
@@ -58,12 +70,13 @@ async def on_command(sid, data):
 
 
     # Save to config the values sent in for the parameter
-    with open(os.path.realpath(os.path.join(os.getcwd(),os.path.dirname(__file__), evolver.CONF_FILENAME)), 'w') as ymlfile:
-        yaml.dump(evolver_conf, ymlfile)
+    with open(CONF_PATH, 'w') as ymlfile:
+        yaml.dump(evolver_conf, ymlfile, Dumper=SafeDumper)
 
     if immediate:
         clear_broadcast(param)
         command_queue.insert(0, {'param': param, 'value': value, 'type': IMMEDIATE})
+        command_event.set()
     await sio.emit('commandbroadcast', data, namespace = '/dpu-evolver')
 
 @sio.on('getconfig', namespace = '/dpu-evolver')
@@ -76,10 +89,8 @@ async def on_getcalibrationnames(sid, data):
     calibration_names = []
     print("Reteiving cal names...", flush = True)
     try:
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME)) as f:
-            calibrations = json.load(f)
-            for calibration in calibrations:
-                calibration_names.append({'name': calibration['name'], 'calibrationType': calibration['calibrationType']})
+        for calibration in load_calibrations():
+            calibration_names.append({'name': calibration['name'], 'calibrationType': calibration['calibrationType']})
     except FileNotFoundError:
         print_calibration_file_error()
 
@@ -90,11 +101,9 @@ async def on_getfitnames(sid, data):
     fit_names = []
     print("Retrieving fit names...", flush = True)
     try:
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME)) as f:
-            calibrations = json.load(f)
-            for calibration in calibrations:
-                for fit in calibration['fits']:
-                    fit_names.append({'name': fit['name'], 'calibrationType': calibration['calibrationType']})
+        for calibration in load_calibrations():
+            for fit in calibration['fits']:
+                fit_names.append({'name': fit['name'], 'calibrationType': calibration['calibrationType']})
     except FileNotFoundError:
         print_calibration_file_error()
 
@@ -103,38 +112,33 @@ async def on_getfitnames(sid, data):
 @sio.on('getcalibration', namespace = '/dpu-evolver')
 async def on_getcalibration(sid, data):
     try:
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME)) as f:
-            calibrations = json.load(f)
-            for calibration in calibrations:
-                if calibration["name"] == data["name"]:
-                    await sio.emit('calibration', calibration, namespace = '/dpu-evolver')
-                    break
+        for calibration in load_calibrations():
+            if calibration["name"] == data["name"]:
+                await sio.emit('calibration', calibration, namespace = '/dpu-evolver')
+                break
     except FileNotFoundError:
         print_calibration_file_error()
 
 @sio.on('setrawcalibration', namespace = '/dpu-evolver')
 async def on_setrawcalibration(sid, data):
     try:
-        calibrations = []
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME)) as f:
-            calibrations = json.load(f)
-
-            # First, delete existing calibration by same name if it exists
-            index_to_delete = -1
-            for i, calibration in enumerate(calibrations):
-                if calibration["name"] == data["name"]:
-                    index_to_delete = i
-            if index_to_delete >= 0:
-                del calibrations[index_to_delete]
-
-            """
-                Add the calibration into the list. `data` should be formatted according
-                to the cal schema, containing a name, params, and raw field.
-            """
-            calibrations.append(data)
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME), 'w') as f:
-            json.dump(calibrations, f)
-            await sio.emit('calibrationrawcallback', 'success', namespace = '/dpu-evolver')
+        calibrations = copy.deepcopy(load_calibrations())
+
+        # First, delete existing calibration by same name if it exists
+        index_to_delete = -1
+        for i, calibration in enumerate(calibrations):
+            if calibration["name"] == data["name"]:
+                index_to_delete = i
+        if index_to_delete >= 0:
+            del calibrations[index_to_delete]
+
+        """
+            Add the calibration into the list. `data` should be formatted according
+            to the cal schema, containing a name, params, and raw field.
+        """
+        calibrations.append(data)
+        save_calibrations(calibrations)
+        await sio.emit('calibrationrawcallback', 'success', namespace = '/dpu-evolver')
     except FileNotFoundError:
         print_calibration_file_error()
 
@@ -146,23 +150,20 @@ async def on_setfitcalibrations(sid, data):
         fits list for a given calibration.
     """
     try:
-        calibrations = []
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME)) as f:
-            calibrations = json.load(f)
-            for calibration in calibrations:
-                if calibration["name"] == data["name"]:
-                    if calibration.get("fits", None) is not None:
-                        index_to_delete = -1
-                        for i, fit in enumerate(calibration['fits']):
-                            if fit["name"] == data["fit"]["name"]:
-                                index_to_delete = i
-                        if index_to_delete >= 0:
-                            del calibrations["fits"][index_to_delete]
-                        calibration["fits"].append(data["fit"])
-                    else:
-                        calibration["fits"] = [].append(data["fit"])
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME), 'w') as f:
-            json.dump(calibrations, f)
+        calibrations = copy.deepcopy(load_calibrations())
+        for calibration in calibrations:
+            if calibration["name"] == data["name"]:
+                if calibration.get("fits", None) is not None:
+                    index_to_delete = -1
+                    for i, fit in enumerate(calibration['fits']):
+                        if fit["name"] == data["fit"]["name"]:
+                            index_to_delete = i
+                    if index_to_delete >= 0:
+                        del calibrations["fits"][index_to_delete]
+                    calibration["fits"].append(data["fit"])
+                else:
+                    calibration["fits"] = [].append(data["fit"])
+        save_calibrations(calibrations)
     except FileNotFoundError:
         print_calibration_file_error()
 
@@ -172,21 +173,19 @@ async def on_setactiveodcal(sid, data):
         active_calibrations = []
         print("Time to set active cals. Data received: ")
         print(data, flush = True)
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME)) as f:
-            calibrations = json.load(f)
-            for calibration in calibrations:
-                active = False
-                for fit in calibration['fits']:
-                    if fit["name"] in data["calibration_names"]:
-                        fit["active"] = True
-                        active = True
-                    else:
-                        fit["active"] = False
-                if active:
-                    active_calibrations.append(calibration)
-            await sio.emit('activecalibrations', active_calibrations, namespace = '/dpu-evolver')
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME), 'w') as f:
-            json.dump(calibrations, f)
+        calibrations = copy.deepcopy(load_calibrations())
+        for calibration in calibrations:
+            active = False
+            for fit in calibration['fits']:
+                if fit["name"] in data["calibration_names"]:
+                    fit["active"] = True
+                    active = True
+                else:
+                    fit["active"] = False
+            if active:
+                active_calibrations.append(calibration)
+        save_calibrations(calibrations)
+        await sio.emit('activecalibrations', active_calibrations, namespace = '/dpu-evolver')
     except FileNotFoundError:
         print_calibration_file_error()
 
@@ -194,13 +193,11 @@ async def on_setactiveodcal(sid, data):
 async def on_getactivecal(sid, data):
     try:
         active_calibrations = []
-        with open(os.path.join(LOCATION, CALIBRATIONS_FILENAME)) as f:
-            calibrations = json.load(f)
-            for calibration in calibrations:
-                for fit in calibration['fits']:
-                    if fit['active']:
-                        active_calibrations.append(calibration)
-                        break;
+        for calibration in load_calibrations():
+            for fit in calibration['fits']:
+                if fit['active']:
+                    active_calibrations.append(calibration)
+                    break;
         await sio.emit('activecalibrations', active_calibrations, namespace = '/dpu-evolver')
     except FileNotFoundError:
         print_calibration_file_error()
@@ -216,8 +213,7 @@ async def on_getdevicename(sid, data):
 async def on_setdevicename(sid, data):
     config_path = os.path.join(LOCATION)
     print('saving device name', flush = True)
-    if not os.path.isdir(config_path):
-        os.mkdir(config_path)
+    os.makedirs(config_path, exist_ok = True)
     with open(os.path.join(config_path, evolver_conf['device']), 'w') as f:
         f.write(json.dumps(data))
     await sio.emit('broadcastname', data, namespace = '/dpu-evolver')
@@ -225,6 +221,44 @@ async def on_setdevicename(sid, data):
 def print_calibration_file_error():
     print("Error reading calibrations file.", flush = True)
 
+def load_calibrations():
+    """
+        Return the parsed calibrations file. The parsed list is cached and only
+        re-read when the file changes on disk. Callers that modify the list
+        must work on a copy and write it back with save_calibrations.
+    """
+    global calibrations_cache
+    stat = os.stat(CALIBRATIONS_PATH)
+    stat = (stat.st_mtime_ns, stat.st_size)
+    if stat != calibrations_cache['stat']:
+        with open(CALIBRATIONS_PATH) as f:
+            calibrations_cache['data'] = json.load(f)
+        calibrations_cache['stat'] = stat
+    return calibrations_cache['data']
+
+def save_calibrations(calibrations):
+    """
+        Write the calibrations file and refresh the cache with its contents.
+        The data is synced to a temporary file that then replaces the original,
+        so a crash or power loss never leaves a truncated calibrations file.
+    """
+    global calibrations_cache
+    with open(CALIBRATIONS_PATH + '.tmp', 'w') as f:
+        json.dump(calibrations, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(CALIBRATIONS_PATH + '.tmp', CALIBRATIONS_PATH)
+
+    # Sync the directory too so the rename itself survives a power loss
+    dir_fd = os.open(LOCATION, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    stat = os.stat(CALIBRATIONS_PATH)
+    calibrations_cache['stat'] = (stat.st_mtime_ns, stat.st_size)
+    calibrations_cache['data'] = calibrations
+
 def clear_broadcast(param=None):
     """ Removes broadcast commands of a specific param from queue """
     global command_queue
@@ -240,7 +274,7 @@ async def run_commands():
         command = command_queue.pop(0)
         try:
             if command['param'] == 'wait':
-                time.sleep(command['value'])
+                await asyncio.sleep(command['value'])
                 continue
             returned_data = serial_communication(command['param'], command['value'], command['type'])
             if returned_data is not None:
@@ -250,27 +284,27 @@ async def run_commands():
     return data
 
 def serial_communication(param, value, comm_type):
+    param_conf = evolver_conf['experimental_params'][param]
     serial_connection.reset_input_buffer()
     serial_connection.reset_output_buffer()
     output = []
 
     # Check that parameters being sent to arduino match expected values
-    if comm_type == RECURRING:
-        output.append(evolver_conf[RECURRING])
-    if comm_type == IMMEDIATE:
-        output.append(evolver_conf[IMMEDIATE])
+    # The command types are the config keys of their command characters
+    if comm_type in (RECURRING, IMMEDIATE):
+        output.append(evolver_conf[comm_type])
 
     if type(value) is list:
        output = output + list(map(str,value))
        for i,command_value in enumerate(output):
             if command_value == 'NaN':
-                output[i] = evolver_conf['experimental_params'][param]['value'][i-1]
+                output[i] = param_conf['value'][i-1]
 
     else:
         output.append(value)
 
-    fields_expected_outgoing = evolver_conf['experimental_params'][param]['fields_expected_outgoing']
-    fields_expected_incoming = evolver_conf['experimental_params'][param]['fields_expected_incoming']
+    fields_expected_outgoing = param_conf['fields_expected_outgoing']
+    fields_expected_incoming = param_conf['fields_expected_incoming']
     if len(output) is not fields_expected_outgoing:
         raise EvolverSerialError('Error: Number of fields outgoing for ' + param + ' different from expected\n\tExpected: ' + str(fields_expected_outgoing) + '\n\tFound: ' + str(len(output)))
 
@@ -278,54 +312,67 @@ def serial_communication(param, value, comm_type):
     serial_output = param + ','.join(output) + ',' + evolver_conf['serial_end_outgoing']
     print(serial_output)
     serial_connection.write(bytes(serial_output, 'UTF-8'))
-    time.sleep(evolver_conf['serial_delay'])
 
-    # Read and process the response
-    response = serial_connection.readline().decode('UTF-8', errors='ignore')
+    # Read and process the response. Responses end in serial_end_incoming with no
+    # newline, so read up to that terminator (or until serial_timeout expires).
+    end_incoming = evolver_conf['serial_end_incoming']
+    response = serial_connection.read_until(end_incoming.encode('UTF-8')).decode('UTF-8', errors='ignore')
     print(response, flush = True)
+    echo_char = evolver_conf['echo_response_char']
+    data_char = evolver_conf['data_response_char']
     address = response[0:len(param)]
     if address != param:
         raise EvolverSerialError('Error: Response has incorrect address.\n\tExpected: ' + param + '\n\tFound:' + address)
-    if response.find(evolver_conf['serial_end_incoming']) != len(response) - len(evolver_conf['serial_end_incoming']):
-        raise EvolverSerialError('Error: Response did not have valid serial communication termination string!\n\tExpected: ' +  evolver_conf['serial_end_incoming'] + '\n\tFound: ' + response[len(response) - 3:])
+    if response.find(end_incoming) != len(response) - len(end_incoming):
+        raise EvolverSerialError('Error: Response did not have valid serial communication termination string!\n\tExpected: ' +  end_incoming + '\n\tFound: ' + response[len(response) - 3:])
 
     # Remove the address and ending from the response string and convert to a list
-    returned_data = response[len(param):len(response) - len(evolver_conf['serial_end_incoming']) - 1].split(',')
+    returned_data = response[len(param):len(response) - len(end_incoming) - 1].split(',')
 
     if len(returned_data) != fields_expected_incoming:
         raise EvolverSerialError('Error: Number of fields recieved for ' + param + ' different from expected\n\tExpected: ' + str(fields_expected_incoming) + '\n\tFound: ' + str(len(returned_data)))
 
-    if returned_data[0] == evolver_conf['echo_response_char'] and output[1:] != returned_data[1:]:
+    if returned_data[0] == echo_char and output[1:] != returned_data[1:]:
         raise EvolverSerialError('Error: Value returned by echo different from values sent.\n\tExpected:' + str(output[1:]) + '\n\tFound: ' + str(value))
-    elif returned_data[0] != evolver_conf['data_response_char'] and returned_data[0] != evolver_conf['echo_response_char']:
-        raise EvolverSerialError('Error: Incorect response character.\n\tExpected: ' + evolver_conf['data_response_char'] + '\n\tFound: ' + returned_data[0])
+    elif returned_data[0] != data_char and returned_data[0] != echo_char:
+        raise EvolverSerialError('Error: Incorect response character.\n\tExpected: ' + data_char + '\n\tFound: ' + returned_data[0])
 
     # ACKNOWLEDGE - lets arduino know it's ok to run any commands (super important!)
-    serial_output = [''] * fields_expected_outgoing
-    serial_output[0] = evolver_conf['acknowledge_char']
-    serial_output = param + ','.join(serial_output) + ',' + evolver_conf['serial_end_outgoing']
+    serial_output = acknowledge_message(param, fields_expected_outgoing, evolver_conf['acknowledge_char'], evolver_conf['serial_end_outgoing'])
     print(serial_output, flush = True)
     serial_connection.write(bytes(serial_output, 'UTF-8'))
 
     # This is necessary to allow the ack to be fully written out to samd21 and for them to fully read
     time.sleep(evolver_conf['serial_delay'])
 
-    if returned_data[0] == evolver_conf['data_response_char']:
+    if returned_data[0] == data_char:
         returned_data = returned_data[1:]
     else:
         returned_data = None
 
     return returned_data
 
-def attach(app, conf):
+@lru_cache(maxsize=None)
+def acknowledge_message(param, fields_expected_outgoing, acknowledge_char, serial_end_outgoing):
+    """
+        Build the acknowledge string for a param. It depends only on its arguments,
+        so it is built once per combination and reused.
+    """
+    serial_output = [''] * fields_expected_outgoing
+    serial_output[0] = acknowledge_char
+    return param + ','.join(serial_output) + ',' + serial_end_outgoing
+
+def attach(app, conf, loop=None):
     """
         Attach the server to the web application.
-        Initialize server from config
+        Initialize server from config. `loop` is the event loop the web
+        application runs on, if it differs from the one broadcasts run on.
     """
-    global evolver_conf, serial_connection
+    global evolver_conf, serial_connection, server_loop
 
     sio.attach(app)
     evolver_conf = conf
+    server_loop = loop
 
     # Set up the serial comms
     serial_connection = serial.Serial(port=evolver_conf['serial_port'], baudrate = evolver_conf['serial_baudrate'], timeout = evolver_conf['serial_timeout'])
@@ -334,6 +381,14 @@ def get_num_commands():
     global command_queue
     return len(command_queue)
 
+def wait_for_commands(timeout):
+    """
+        Block until a command is queued or the timeout (in seconds) expires.
+        The queue itself remains the source of truth; this only wakes the caller.
+    """
+    command_event.wait(timeout)
+    command_event.clear()
+
 def process_commands(parameters):
     """
         Add all recurring commands and pre/post commands to the command queue
@@ -376,4 +431,16 @@ async def broadcast(commands_in_queue):
         broadcast_data['ip'] = evolver_conf['evolver_ip']
         broadcast_data['timestamp'] = time.time()
         print(broadcast_data, flush = True)
-        await sio.emit('broadcast', broadcast_data, namespace='/dpu-evolver')
+        await emit_threadsafe('broadcast', broadcast_data)
+
+async def emit_threadsafe(event, data):
+    """
+        Emit on the /dpu-evolver namespace from any event loop. Socket.io state
+        belongs to the loop the web application runs on, so when called from
+        another loop the emit is handed over to it and awaited from here.
+    """
+    emit = sio.emit(event, data, namespace='/dpu-evolver')
+    if server_loop is None or server_loop is asyncio.get_event_loop():
+        await emit
+    else:
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(emit, server_loop))
@@ -50,10 +50,7 @@ def process_raw(calibration_raw_directory):
                 for param, param_vial_datas in step.items():
                     if param in VALID_PARAMS:
                         for i, vial_data in enumerate(param_vial_datas):
-                            cal_datas[param][i] = [0] * 16
-                            for j in range(16):
-                                index_change = -j + i
-                                cal_datas[param][i][j] = param_vial_datas[index_change]
+                            cal_datas[param][i] = [param_vial_datas[i - j] for j in range(16)]
                         raw_calibrations[filename_split].append(create_raw(param, filename_split, cal_datas[param]))
     return measured_datas, raw_calibrations
 